@@ -36,20 +36,29 @@ journalwatch comes with ABSOLUTELY NO WARRANTY.
 import os
 import os.path
 import time
+import io
 import re
+import functools
 import sys
 import socket
 import shlex
+import collections
 import logging
+import pickle
 import subprocess
 import configparser
 import argparse
-from io import BytesIO
 from systemd import journal
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.generator import BytesGenerator
 
+try:
+    # google-re2 matches in linear time, which helps with large pattern files.
+    import re2
+except ImportError:
+    re2 = None
+
 
 __version__ = "1.1.0"
 
@@ -63,6 +72,8 @@ CONFIG_DIR = os.path.join(XDG_CONFIG_HOME, 'journalwatch')
 DATA_DIR = os.path.join(XDG_DATA_HOME, 'journalwatch')
 TIME_FILE = os.path.join(DATA_DIR, 'time')
 PATTERN_FILE = os.path.join(CONFIG_DIR, 'patterns')
+PATTERN_CACHE_FILE = os.path.join(DATA_DIR, 'patterns.cache')
+HITS_FILE = os.path.join(DATA_DIR, 'hits')
 CONFIG_FILE = os.path.join(CONFIG_DIR, 'config')
 
 config = None
@@ -206,57 +217,229 @@ def parse_args():
     parser.add_argument('--version', action='version',
                         version='%(prog)s {}'.format(__version__))
     ns = parser.parse_args(remaining_argv)
+    # Split the mail arguments once at config time instead of at every use.
+    ns.mail_args = shlex.split(ns.mail_args)
     return ns
 
 
-def read_patterns(iterable):
+# How pattern alternatives are joined in a combined block regex. Also used to
+# split the sources apart again when extracting literal prefixes.
+_ALTERNATION_SEP = ')|(?:'
+
+# Characters with a special meaning in a regex, ending a literal prefix.
+_SPECIAL_CHARS = frozenset('\\^$.|?*+(){}[]')
+
+
+def _combine_patterns(sources):
+    """Compile a block's pattern sources into a single alternation regex.
+
+    Matching one combined regex per block is much cheaper than looping over
+    the patterns in Python and matching each one separately.
+
+    Args:
+        sources: A list of pattern source strings.
+    """
+    return _compile_filter('(?:' + _ALTERNATION_SEP.join(sources) + ')')
+
+
+# Blocks with fewer patterns than this get one combined regex; grouping only
+# pays off once a block has enough patterns to share literal prefixes.
+_PREFIX_GROUP_MIN = 4
+
+# Group constructs which break when patterns share one alternation: named
+# groups collide, and numbered backreferences (including conditionals) get
+# renumbered by the groups of preceding patterns.
+_GROUP_CONSTRUCT_RE = re.compile(r'\\\d|\(\?P|\(\?\(')
+
+
+def _combine_safely(sources):
+    """Combine sources into one regex, splitting them up if that fails.
+
+    A safety net for group constructs _GROUP_CONSTRUCT_RE doesn't catch:
+    compiling each pattern on its own matches the baseline behavior of one
+    regex per line.
+    """
+    if len(sources) > 1:
+        try:
+            return [_combine_patterns(sources)]
+        except re.error:
+            return [_combine_patterns([source]) for source in sources]
+    return [_combine_patterns(sources)]
+
+
+def _group_patterns(sources):
+    """Compile a block's patterns into a list of combined regexes.
+
+    Patterns sharing the same leading literal character are combined into one
+    alternation each, keeping the regex engine's first-character fast path
+    intact - a single alternation over patterns with differing first
+    characters would defeat it. Patterns without any literal prefix share one
+    group since they can't use that fast path anyway.
+
+    Small blocks aren't worth splitting up and get a single alternation, so
+    one regex call checks the whole block.
+
+    Patterns using named groups or backreferences can't share an alternation
+    at all - named groups would collide and backreference numbers would
+    shift - so those keep a regex of their own.
+
+    Args:
+        sources: A list of pattern source strings.
+
+    Return:
+        A list of compiled regex objects.
+    """
+    singles = []
+    combinable = []
+    for source in sources:
+        if _GROUP_CONSTRUCT_RE.search(source):
+            singles.append(source)
+        else:
+            combinable.append(source)
+    patterns = [_combine_patterns([source]) for source in singles]
+    if not combinable:
+        return patterns
+    if len(combinable) < _PREFIX_GROUP_MIN:
+        return patterns + _combine_safely(combinable)
+    groups = {}
+    for source in combinable:
+        groups.setdefault(_literal_prefix(source)[:1], []).append(source)
+    for group in groups.values():
+        patterns += _combine_safely(group)
+    return patterns
+
+
+def _literal_prefix(source):
+    """Get the leading literal text of a regex source.
+
+    Return:
+        The literal prefix every matching string has to start with, or an
+        empty string if no such prefix can be extracted.
+    """
+    # A top-level alternation makes any leading literal text optional, so we
+    # can't use it as a prefix.
+    depth = 0
+    in_class = False
+    escaped = False
+    for c in source:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return ''
+    prefix = []
+    for c in source:
+        if c in _SPECIAL_CHARS:
+            if c in '?*{' and prefix:
+                # A quantifier can make the preceding character optional.
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+def _block_prefixes(filt):
+    """Get the literal prefixes for a combined block regex.
+
+    Args:
+        filt: A compiled pattern as returned by _combine_patterns().
+
+    Return:
+        A tuple of prefixes usable with str.startswith() as a cheap gate
+        before running the regex, or None if some pattern in the block has no
+        literal prefix.
+    """
+    source = filt.pattern
+    if not (source.startswith('(?:') and source.endswith(')')):
+        return None
+    prefixes = tuple(_literal_prefix(s)
+                     for s in source[3:-1].split(_ALTERNATION_SEP))
+    if not all(prefixes):
+        return None
+    return prefixes
+
+
+def _bytes_fullmatch(filt):
+    """Get a fullmatch callable matching a filter against raw bytes.
+
+    Binary journal messages ('blob data') can't be matched as text, so each
+    filter also gets a bytes-compiled twin where possible. Only ASCII
+    sources qualify - encoding non-ASCII patterns would change what they
+    match.
+
+    Args:
+        filt: A compiled (str) pattern as returned by _combine_patterns().
+
+    Return:
+        A bound fullmatch method of the bytes pattern, or None.
+    """
+    try:
+        return re.compile(filt.pattern.encode('ascii')).fullmatch
+    except (UnicodeEncodeError, re.error):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_filter(source):
+    """Compile a filter regex source to a pattern object.
+
+    Memoized so identical sources (e.g. the same block in the pattern cache
+    and a re-parse, or duplicated patterns) share one compiled object -
+    compiled patterns with their NFA tables aren't small.
+    """
+    if re2 is not None:
+        try:
+            return re2.compile(source)
+        except re2.error:
+            # RE2 doesn't support some constructs (e.g. backreferences), so
+            # fall back to the stdlib engine for those.
+            pass
+    return re.compile(source)
+
+
+def read_patterns(text):
     """Read the patterns file.
 
     Args:
-        iterable: An iterable (e.g. a file object) to read the patterns from.
+        text: The contents of the patterns file as a string.
 
     Return:
-        A dict with a mapping of (key, value) tuples to a list of filter regex
-        objects. Value can be a string or a regex object.
+        A dict with a mapping of (key, value) tuples to a list of filter
+        regex objects together matching any of the block's patterns. Value
+        can be a string or a regex object.
     """
-    # The output dict
     patterns = {}
-    # Whether the next line is a header (key = value)
-    is_header = True
-    # The patterns for the current block
-    cur_patterns = []
-    # The current header
-    header = None
-    for line in iterable:
-        if line.startswith('#'):
-            # Ignore comments
-            pass
-        elif not line.strip():
-            # An empty line starts a new block and saves the accumulated
-            # patterns.
-            is_header = True
-            if header is not None and cur_patterns:
-                patterns[header] = cur_patterns
-            cur_patterns = []
-            header = None
-        elif is_header:
-            # We got a non-empty line after an empty one so this is a header.
-            try:
-                k, v = line.split('=')
-            except ValueError:
-                raise JournalWatchError(
-                    "Got config line '{}' without header!".format(line))
-            v = v.strip()
-            if v.startswith('/') and v.endswith('/'):
-                v = re.compile(v[1:-1])
-            header = (k.strip(), v)
-            is_header = False
-        else:
-            # We got a non-empty line anywhere else, so this is a filter.
-            cur_patterns.append(re.compile(line.rstrip('\n')))
-    # Also add the last block to the patterns
-    if header is not None and cur_patterns:
-        patterns[header] = cur_patterns
+    # Blocks are delimited by (whitespace-only) empty lines.
+    for block in re.split(r'\n\s*\n', text):
+        # Ignore comments
+        lines = [line for line in block.splitlines()
+                 if line and not line.startswith('#')]
+        if not lines:
+            continue
+        # The first line of a block is the header (key = value), the rest are
+        # the filters.
+        header, *filters = lines
+        k, sep, v = header.partition('=')
+        if not sep:
+            raise JournalWatchError(
+                "Got config line '{}' without header!".format(header))
+        v = v.strip()
+        if v.startswith('/') and v.endswith('/'):
+            v = re.compile(v[1:-1])
+        if filters:
+            # Intern the key so the per-entry dict lookups in filter_message
+            # can use the interned fast path.
+            patterns[(sys.intern(k.strip()), v)] = _group_patterns(filters)
     return patterns
 
 
@@ -278,64 +461,279 @@ def read_entry_message(entry, *, replace_empty=False):
     return message
 
 
+@functools.lru_cache(maxsize=16)
+def _ctime(dt):
+    """Cached ctime for a timestamp truncated to seconds."""
+    return datetime.ctime(dt)
+
+
+def _format_timestamp(dt):
+    """Format a timestamp, reusing the result for repeated seconds.
+
+    Journal entries often arrive in bursts sharing the same second, in which
+    case the previously formatted string can be reused as-is. A small LRU
+    keeps the last few seconds around so interleaved streams still hit it.
+    """
+    return _ctime(dt.replace(microsecond=0))
+
+
+@functools.lru_cache(maxsize=None)
+def _entry_formatter(has_unit, has_time, has_prio, has_ident, has_pid):
+    """Build a formatter function for entries with the given fields.
+
+    Journal entries only come with a handful of different field
+    combinations, so the formatters get memoized and the per-field presence
+    checks run once per combination instead of once per entry. Constant
+    pieces are baked into a single format template, so formatting an entry
+    is one str.format() call filling in only the varying fields.
+
+    Return:
+        A callable taking an entry and returning the formatted string.
+    """
+    pieces = ['U' if has_unit else 'S']
+    if has_time:
+        pieces.append(lambda e: _format_timestamp(e['__REALTIME_TIMESTAMP']))
+    if has_prio:
+        pieces.append(lambda e: 'p' + str(e['PRIORITY']))
+    if has_unit:
+        pieces.append(lambda e: str(e['_SYSTEMD_UNIT']))
+    if has_ident and has_pid:
+        pieces.append(lambda e: '{}[{}]:'.format(e['SYSLOG_IDENTIFIER'],
+                                                 e['_PID']))
+    elif has_ident:
+        pieces.append(lambda e: str(e['SYSLOG_IDENTIFIER']) + ':')
+    elif has_pid:
+        pieces.append(lambda e: '[{}]:'.format(e['_PID']))
+    else:
+        pieces.append(':')
+    pieces.append(lambda e: read_entry_message(e, replace_empty=True))
+
+    template = ' '.join('{}' if callable(p) else p for p in pieces)
+    getters = [p for p in pieces if callable(p)]
+
+    def format_fields(entry):
+        return template.format(*(g(entry) for g in getters))
+
+    return format_fields
+
+
 def format_entry(entry):
     """Format a systemd log entry to a string.
 
     Args:
         entry: A systemd.journal.Reader entry.
     """
-    words = []
-    if '_SYSTEMD_UNIT' in entry:
-        words.append('U')
-    else:
-        words.append('S')
-    if '__REALTIME_TIMESTAMP' in entry:
-        words.append(datetime.ctime(entry['__REALTIME_TIMESTAMP']))
-    if 'PRIORITY' in entry:
-        words.append('p'+str(entry['PRIORITY']))
-    if '_SYSTEMD_UNIT' in entry:
-        words.append(entry['_SYSTEMD_UNIT'])
-    name = ''
-    if 'SYSLOG_IDENTIFIER' in entry:
-        name += entry['SYSLOG_IDENTIFIER']
-    if '_PID' in entry:
-        name += '[{}]'.format(entry['_PID'])
-    name += ':'
-    words.append(name)
-    words.append(read_entry_message(entry, replace_empty=True))
-    return ' '.join(map(str, words))
-
-
-def filter_message(patterns, entry):
+    formatter = _entry_formatter('_SYSTEMD_UNIT' in entry,
+                                 '__REALTIME_TIMESTAMP' in entry,
+                                 'PRIORITY' in entry,
+                                 'SYSLOG_IDENTIFIER' in entry,
+                                 '_PID' in entry)
+    return formatter(entry)
+
+
+# How often each pattern group matched during this run, keyed by the group's
+# stable (field, value source, pattern source) key.
+_hit_counts = collections.Counter()
+
+
+def _load_hits():
+    """Load the persisted per-group hit counts.
+
+    Return:
+        A dict mapping group keys to counts, empty if there are none.
+    """
+    try:
+        with open(HITS_FILE, 'rb') as f:
+            hits = pickle.load(f)
+    except (OSError, EOFError, pickle.PickleError, ValueError):
+        return {}
+    if not isinstance(hits, dict):
+        return {}
+    return hits
+
+
+def _save_hits(hits):
+    """Merge this run's hit counts into the persisted ones and save them.
+
+    Args:
+        hits: The previously persisted counts, as returned by _load_hits().
+    """
+    for key, count in _hit_counts.items():
+        hits[key] = hits.get(key, 0) + count
+    try:
+        with open(HITS_FILE, 'wb') as f:
+            pickle.dump(hits, f)
+    except OSError:
+        # The counts only steer the check order, never fail because of them.
+        pass
+
+
+def build_matchers(patterns, hits=None):
+    """Prepare the patterns for the filtering hot loop.
+
+    The polymorphic value check (string vs. regex) is resolved here once
+    instead of once per block per journal entry.
+
+    Args:
+        patterns: The patterns as returned by read_patterns().
+        hits: Persisted hit counts as returned by _load_hits(), used to check
+              frequently matching groups first. A few patterns usually catch
+              most of the journal, so earlier runs' counts are a good
+              predictor.
+
+    Return:
+        A dict mapping journal field names to (exact, regex_blocks) tuples.
+        exact maps literal header values to their groups, so blocks with a
+        string value are found with a single dict lookup; regex_blocks is a
+        list of (match_value, groups) tuples for regex header values. groups
+        is a list of (match_message, match_bytes, prefixes, key) tuples with
+        a bytes-matching variant (or None), a tuple of literal message
+        prefixes per group (or None) and the group's stable hit-count key.
+    """
+    matchers = {}
+    live_keys = set()
+    for (k, v), filts in patterns.items():
+        # Keys coming from the pattern cache are unpickled and thus not
+        # interned yet; entry lookups benefit from the identity fast path.
+        k = sys.intern(k)
+        exact, regex_blocks = matchers.setdefault(k, ({}, []))
+        v_source = v.pattern if isinstance(v, re.Pattern) else v
+        groups = [(filt.fullmatch, _bytes_fullmatch(filt),
+                   _block_prefixes(filt), (k, v_source, filt.pattern))
+                  for filt in filts]
+        live_keys.update(group[3] for group in groups)
+        if isinstance(v, re.Pattern):
+            regex_blocks.append((v.fullmatch, groups))
+        else:
+            exact.setdefault(v, []).extend(groups)
+    if hits:
+        # Drop counts of deleted or edited patterns so the persisted file
+        # doesn't grow without bound.
+        for key in set(hits) - live_keys:
+            del hits[key]
+        # Check the groups which matched most often in earlier runs first.
+        def group_hits(group):
+            return hits.get(group[3], 0)
+        for exact, regex_blocks in matchers.values():
+            for groups in exact.values():
+                groups.sort(key=group_hits, reverse=True)
+            for _match_value, groups in regex_blocks:
+                groups.sort(key=group_hits, reverse=True)
+            regex_blocks.sort(
+                key=lambda block: max(map(group_hits, block[1]), default=0),
+                reverse=True)
+    return matchers
+
+
+def _match_groups(groups, msg):
+    """Check if a message matches any of a block's pattern groups.
+
+    Args:
+        groups: A list of (match_message, match_bytes, prefixes, key) tuples.
+        msg: The message to match against, as str or bytes.
+    """
+    if isinstance(msg, bytes):
+        # Binary messages get matched against the bytes-compiled filters.
+        for _match_message, match_bytes, _prefixes, key in groups:
+            if match_bytes is not None and match_bytes(msg):
+                _hit_counts[key] += 1
+                return True
+        return False
+    for match_message, _match_bytes, prefixes, key in groups:
+        # A cheap literal prefix check before running the regex.
+        if prefixes is not None and not msg.startswith(prefixes):
+            continue
+        if match_message(msg):
+            _hit_counts[key] += 1
+            return True
+    return False
+
+
+def filter_message(matchers, entry):
     """Check if a message is filtered by any filter.
 
     Args:
-        patterns: The patterns to apply, as returned by read_patterns().
+        matchers: The prepared patterns, as returned by build_matchers().
         entry: A systemd.journal.Reader entry.
     """
     if 'MESSAGE' not in entry:
         return False
-    for (k, v), cur_patterns in patterns.items():
-        if k not in entry:
-            # If the message doesn't have this key, we ignore it.
+    # Binary messages stay bytes here so they can be matched as-is; the blob
+    # placeholder from read_entry_message() is only for display.
+    msg = entry['MESSAGE']
+    for k, (exact, regex_blocks) in matchers.items():
+        val = entry.get(k)
+        if val is None:
+            # If the message doesn't have this key, we ignore all its blocks.
             continue
-        # Now check if the message key matches the key we're currently looking
-        # at
-        if hasattr(v, 'fullmatch'):
-            if not v.fullmatch(str(entry[k])):
-                continue
-        else:
-            if str(entry[k]) != v:
-                continue
-        # If we arrive here, the keys matched so we need to check these
-        # patterns.
-        for filt in cur_patterns:
-            if filt.fullmatch(read_entry_message(entry)):
+        # Most journal fields already are strings, so avoid a useless str()
+        # round-trip for them.
+        sval = val if type(val) is str else str(val)
+        # Blocks with a literal header value are found with one dict lookup.
+        groups = exact.get(sval)
+        if groups is not None and _match_groups(groups, msg):
+            return True
+        # Regex header values still get checked one by one.
+        for match_value, groups in regex_blocks:
+            if match_value(sval) and _match_groups(groups, msg):
                 return True
     # No patterns on no key/value blocks matched.
     return False
 
 
+def _pattern_cache_key(st):
+    """Get the cache key for a stat result of the pattern file."""
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load_pattern_cache(key):
+    """Load the cached pattern sources if they're still up to date.
+
+    Args:
+        key: The cache key for the current pattern file.
+
+    Return:
+        The patterns dict as returned by read_patterns(), or None if the
+        cache is missing or outdated.
+    """
+    try:
+        with open(PATTERN_CACHE_FILE, 'rb') as f:
+            cached_key, blocks = pickle.load(f)
+        if cached_key != key:
+            return None
+        patterns = {}
+        for k, v_source, v_is_regex, filt_sources in blocks:
+            v = re.compile(v_source) if v_is_regex else v_source
+            patterns[(k, v)] = [_compile_filter(s) for s in filt_sources]
+    except (OSError, EOFError, pickle.PickleError, ValueError, TypeError,
+            re.error):
+        # A stale or malformed cache just means a full re-parse.
+        return None
+    return patterns
+
+
+def _save_pattern_cache(key, patterns):
+    """Save the pattern sources to the cache.
+
+    Args:
+        key: The cache key for the current pattern file.
+        patterns: The patterns dict as returned by read_patterns().
+    """
+    blocks = []
+    for (k, v), filts in patterns.items():
+        sources = [filt.pattern for filt in filts]
+        if isinstance(v, re.Pattern):
+            blocks.append((k, v.pattern, True, sources))
+        else:
+            blocks.append((k, v, False, sources))
+    try:
+        with open(PATTERN_CACHE_FILE, 'wb') as f:
+            pickle.dump((key, blocks), f)
+    except OSError:
+        # The cache is just an optimization, never fail because of it.
+        pass
+
+
 def parse_config_files():
     """Parse the config and pattern files.
 
@@ -343,26 +741,33 @@ def parse_config_files():
         A (config, patterns) tuple.
     """
     cfg = parse_args()
-    if not os.path.exists(XDG_DATA_HOME):
-        os.makedirs(XDG_DATA_HOME, mode=0o700)
-    if not os.path.exists(XDG_CONFIG_HOME):
-        os.makedirs(XDG_CONFIG_HOME, mode=0o700)
-
-    if not os.path.exists(CONFIG_DIR):
-        os.makedirs(CONFIG_DIR)
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-
-    if not os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'w') as f:
+    os.makedirs(XDG_DATA_HOME, mode=0o700, exist_ok=True)
+    os.makedirs(XDG_CONFIG_HOME, mode=0o700, exist_ok=True)
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    try:
+        with open(CONFIG_FILE, 'x') as f:
             f.write(DEFAULT_CONFIG)
-    if not os.path.exists(PATTERN_FILE):
-        with open(PATTERN_FILE, 'w') as f:
+    except FileExistsError:
+        pass
+    try:
+        with open(PATTERN_FILE, 'x') as f:
             f.write(DEFAULT_PATTERNS)
-        patterns = read_patterns(DEFAULT_PATTERNS.splitlines())
+    except FileExistsError:
+        key = _pattern_cache_key(os.stat(PATTERN_FILE))
+        patterns = _load_pattern_cache(key)
+        if patterns is None:
+            # Read the raw bytes in one go and decode once, skipping the
+            # text layer's incremental decoding and newline translation.
+            with open(PATTERN_FILE, 'rb') as f:
+                patterns = read_patterns(f.read().decode('utf-8'))
+            _save_pattern_cache(key, patterns)
     else:
-        with open(PATTERN_FILE) as f:
-            patterns = read_patterns(f)
+        patterns = read_patterns(DEFAULT_PATTERNS)
+        # Prime the cache so the next run starts warm right away.
+        _save_pattern_cache(_pattern_cache_key(os.stat(PATTERN_FILE)),
+                            patterns)
     if not patterns:
         raise JournalWatchError("No patterns defined in {}!".format(
             PATTERN_FILE))
@@ -393,22 +798,22 @@ def get_journal(since=None, priority=None):
     return j
 
 
-def send_mail(output, since=None):
+def send_mail(text, count, since=None):
     """Send the log text via mail to the user.
 
     Args:
-        output: A list of log lines.
+        text: The log text to send.
+        count: The number of log lines in the text.
         since: A datetime object when the collection started.
     """
     if since is None:
         start = 'beginning of time'
     else:
         start = datetime.ctime(since)
-    text = '\n'.join(output)
     mail = MIMEText(text)
     mail['Subject'] = config.mail_subject.format(
         hostname=socket.gethostname(),
-        count=len(output),
+        count=count,
         start=start,
         end=datetime.ctime(datetime.now()))
     mail['From'] = config.mail_from
@@ -419,25 +824,23 @@ def send_mail(output, since=None):
                                 "Please set it either as argument or in "
                                 "{}.".format(CONFIG_FILE))
     argv = [config.mail_binary]
-    argv += shlex.split(config.mail_args)
+    argv += config.mail_args
     logging.debug("Sending mail from {} to {}.".format(
         config.mail_from, config.mail_to))
     logging.debug("Subject: {}".format(mail['Subject']))
     logging.debug("Calling command {}".format(argv))
     p = subprocess.Popen(argv, stdin=subprocess.PIPE)
-    p.communicate(mail_to_bytes(mail))
-
-
-def mail_to_bytes(mail):
-    """Get bytes based on a mail.
-
-    Based on email.Message.as_bytes, but we reimplement it here because python
-    3.3 lacks it.
-    """
-    fp = BytesIO()
-    g = BytesGenerator(fp, mangle_from_=False, policy=mail.policy)
-    g.flatten(mail, unixfrom=False)
-    return fp.getvalue()
+    # Flatten the mail directly into the pipe instead of serializing it to an
+    # intermediate bytes copy first.
+    try:
+        g = BytesGenerator(p.stdin, mangle_from_=False, policy=mail.policy)
+        g.flatten(mail, unixfrom=False)
+        p.stdin.close()
+    except BrokenPipeError:
+        # The mail binary exited before draining its stdin - nothing left to
+        # do but wait for it, like communicate() used to handle quietly.
+        pass
+    p.wait()
 
 
 def parse_since():
@@ -474,32 +877,71 @@ def write_time_file():
 
 
 def print_output(output):
-    """Print the output to console safely."""
+    """Print the output to console safely.
+
+    Args:
+        output: An iterable of log lines.
+    """
+    out = sys.stdout.buffer
     encoding = sys.stdout.encoding
     for line in output:
-        line = line.encode(encoding, errors='replace').decode(encoding)
-        print(line)
+        out.write(line.encode(encoding, errors='replace'))
+        out.write(b'\n')
+    out.flush()
+
+
+def iter_output(j, matchers):
+    """Generate the formatted lines surviving the filters.
+
+    Args:
+        j: A systemd.journal.Reader.
+        matchers: The prepared patterns, as returned by build_matchers().
+    """
+    for entry in j:
+        if not filter_message(matchers, entry):
+            yield format_entry(entry)
+
+
+def _run_mail(j, matchers, since):
+    """Collect the filtered output and mail it if there is any.
+
+    Unlike the print path this materializes the text, since the mail
+    subject needs the line count before the body can be sent.
+    """
+    buf = io.StringIO()
+    count = 0
+    for line in iter_output(j, matchers):
+        if count:
+            buf.write('\n')
+        buf.write(line)
+        count += 1
+    if count:
+        send_mail(buf.getvalue(), count, since)
+
+
+def _run_print(j, matchers):
+    """Print the filtered output line by line as it's produced."""
+    print_output(iter_output(j, matchers))
 
 
 def run():
     """Main entry point. Filter the log and output it or send a mail."""
     global config
-    output = []
     config, patterns = parse_config_files()
+    hits = _load_hits()
+    matchers = build_matchers(patterns, hits)
     loglevel = logging.DEBUG if config.verbose else logging.WARNING
     logging.basicConfig(level=loglevel, format='%(asctime)s [%(levelname)s] %(message)s',)
     since = parse_since()
     write_time_file()
     j = get_journal(since, config.priority)
-    for entry in j:
-        if not filter_message(patterns, entry):
-            output.append(format_entry(entry))
-    if not output:
-        return
     if config.action == 'mail':
-        send_mail(output, since)
+        _run_mail(j, matchers, since)
     else:
-        print_output(output)
+        _run_print(j, matchers)
+    # Save unconditionally: even without new hits, build_matchers may have
+    # pruned counts of removed patterns.
+    _save_hits(hits)
 
 
 def main():
@@ -1,6 +1,5 @@
 import io
 import os.path
-import re
 from setuptools import setup
 
 
@@ -13,11 +12,9 @@ def read(*names, **kwargs):
 
 
 def find_version(*file_paths):
-    version_file = read(*file_paths)
-    version_match = re.search(r"^__version__ = ['\"]([^'\"]*)['\"]",
-                              version_file, re.M)
-    if version_match:
-        return version_match.group(1)
+    for line in read(*file_paths).splitlines():
+        if line.startswith('__version__'):
+            return line.split('=', 1)[1].strip().strip('\'"')
     raise RuntimeError("Unable to find version string.")
 
 
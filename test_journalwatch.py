@@ -5,6 +5,31 @@ import pytest
 
 import journalwatch
 
+# The real optional re2 module, before the autouse fixture pins it away.
+REAL_RE2 = journalwatch.re2
+
+
+@pytest.fixture(autouse=True)
+def no_re2(monkeypatch):
+    """Pin the stdlib regex engine for stable pattern comparisons.
+
+    With google-re2 installed, _compile_filter would return re2 pattern
+    objects and the re.compile(...) equality assertions would fail.
+    """
+    monkeypatch.setattr(journalwatch, 're2', None)
+    journalwatch._compile_filter.cache_clear()
+    yield
+    journalwatch._compile_filter.cache_clear()
+
+
+@pytest.mark.skipif(REAL_RE2 is None, reason="re2 not installed")
+def test_compile_filter_re2(monkeypatch):
+    monkeypatch.setattr(journalwatch, 're2', REAL_RE2)
+    journalwatch._compile_filter.cache_clear()
+    filt = journalwatch._compile_filter('(?:bar)')
+    assert filt.fullmatch('bar')
+    assert not filt.fullmatch('baz')
+
 
 def test_read_patterns():
     lines = [
@@ -16,10 +41,39 @@ def test_read_patterns():
         'fish',
     ]
     expected = {
-        ('_SYSTEMD_UNIT', 'foo'): [re.compile('bar')],
-        ('_SYSTEMD_UNIT', re.compile('baz')): [re.compile('fish')],
+        ('_SYSTEMD_UNIT', 'foo'): [re.compile('(?:bar)')],
+        ('_SYSTEMD_UNIT', re.compile('baz')): [re.compile('(?:fish)')],
     }
-    assert journalwatch.read_patterns(lines) == expected
+    assert journalwatch.read_patterns('\n'.join(lines)) == expected
+
+
+def test_read_patterns_group_constructs():
+    lines = [
+        '_SYSTEMD_UNIT = foo',
+        r'(?P<user>\w+) logged in',
+        r'(?P<user>\w+) logged out',
+        r'user (\w+) is \1',
+    ]
+    matchers = journalwatch.build_matchers(
+        journalwatch.read_patterns('\n'.join(lines)))
+    for msg in ['alice logged in', 'bob logged out', 'user x is x']:
+        entry = {'_SYSTEMD_UNIT': 'foo', 'MESSAGE': msg}
+        assert journalwatch.filter_message(matchers, entry)
+    entry = {'_SYSTEMD_UNIT': 'foo', 'MESSAGE': 'user x is y'}
+    assert not journalwatch.filter_message(matchers, entry)
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('New session \\w+', 'New session '),
+    ('pam_unix\\(crond:session\\)', 'pam_unix'),
+    ('(Stopped|Stopping) .*', ''),
+    ('foo|bar', ''),
+    ('Startup finished in \\d*ms\\.', 'Startup finished in '),
+    ('abc*', 'ab'),
+    ('literal', 'literal'),
+])
+def test_literal_prefix(source, expected):
+    assert journalwatch._literal_prefix(source) == expected
 
 
 @pytest.mark.parametrize('entry, expected', [
@@ -46,48 +100,72 @@ def test_format_entry(entry, expected):
     ({}, {'MESSAGE': 'foo'}, False),
     # No message
     (
-        {('_SYSLOG_IDENTIFIER', 'foo'): [re.compile('bar')]},
+        {('_SYSLOG_IDENTIFIER', 'foo'): [re.compile('(?:bar)')]},
         {'_SYSLOG_IDENTIFIER': 'foo'},
         False
     ),
     # No matching pattern
     (
-        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('bar')]},
+        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('(?:bar)')]},
         {'_SYSLOG_IDENTIFIER': 'foo', 'MESSAGE': 'unmatched'},
         False
     ),
     # Matching pattern
     (
-        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('msg')]},
+        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('(?:msg)')]},
         {'_SYSLOG_IDENTIFIER': 'bar', 'MESSAGE': 'msg'},
         True
     ),
     # Regex as identifier
     (
-        {('_SYSLOG_IDENTIFIER', re.compile('bar')): [re.compile('msg')]},
+        {('_SYSLOG_IDENTIFIER', re.compile('bar')): [re.compile('(?:msg)')]},
         {'_SYSLOG_IDENTIFIER': 'bar', 'MESSAGE': 'msg'},
         True
     ),
     # Matching priority (#7)
     (
-        {('PRIORITY', '1'): [re.compile('msg')]},
+        {('PRIORITY', '1'): [re.compile('(?:msg)')]},
         {'PRIORITY': 1, 'MESSAGE': 'msg'},
         True
     ),
     (
-        {('PRIORITY', re.compile('1')): [re.compile('msg')]},
+        {('PRIORITY', re.compile('1')): [re.compile('(?:msg)')]},
         {'PRIORITY': 1, 'MESSAGE': 'msg'},
         True
     ),
     # Binary message (#5)
     (
-        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('msg')]},
+        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('(?:msg)')]},
         {'_SYSLOG_IDENTIFIER': 'bar', 'MESSAGE': b'\xde\xad\xbe\xef'},
         False
     ),
+    # Binary message matching a pattern
+    (
+        {('_SYSLOG_IDENTIFIER', 'bar'): [re.compile('(?:binary .*)')]},
+        {'_SYSLOG_IDENTIFIER': 'bar', 'MESSAGE': b'binary blob'},
+        True
+    ),
 ])
 def test_filter_message(patterns, entry, filtered):
-    assert journalwatch.filter_message(patterns, entry) == filtered
+    matchers = journalwatch.build_matchers(patterns)
+    assert journalwatch.filter_message(matchers, entry) == filtered
+
+
+def test_build_matchers_hit_order():
+    patterns = {
+        ('SYSLOG_IDENTIFIER', re.compile('a')): [re.compile('(?:one)')],
+        ('SYSLOG_IDENTIFIER', re.compile('b')): [re.compile('(?:two)')],
+    }
+    hits = {
+        ('SYSLOG_IDENTIFIER', 'b', '(?:two)'): 5,
+        ('SYSLOG_IDENTIFIER', 'gone', '(?:gone)'): 3,
+    }
+    matchers = journalwatch.build_matchers(patterns, hits)
+    _exact, regex_blocks = matchers['SYSLOG_IDENTIFIER']
+    # The block which matched more often in earlier runs is checked first.
+    assert regex_blocks[0][0] == re.compile('b').fullmatch
+    # Counts of patterns which no longer exist get pruned.
+    assert ('SYSLOG_IDENTIFIER', 'gone', '(?:gone)') not in hits
 
 
 def test_new_config_files(monkeypatch, tmpdir):
@@ -105,6 +183,34 @@ def test_new_config_files(monkeypatch, tmpdir):
     monkeypatch.setattr(journalwatch, 'CONFIG_DIR', str(config_dir))
     monkeypatch.setattr(journalwatch, 'CONFIG_FILE', str(config_file))
     monkeypatch.setattr(journalwatch, 'PATTERN_FILE', str(pattern_file))
+    monkeypatch.setattr(journalwatch, 'PATTERN_CACHE_FILE',
+                        str(data_dir / 'patterns.cache'))
 
     journalwatch.parse_config_files()
     assert pattern_file.read() == journalwatch.DEFAULT_PATTERNS
+
+
+def test_pattern_cache(monkeypatch, tmpdir):
+    pattern_file = tmpdir / 'patterns'
+    cache_file = tmpdir / 'patterns.cache'
+
+    monkeypatch.setattr(journalwatch, 'parse_args', lambda: None)
+    monkeypatch.setattr(journalwatch, 'XDG_DATA_HOME', str(tmpdir))
+    monkeypatch.setattr(journalwatch, 'DATA_DIR', str(tmpdir))
+    monkeypatch.setattr(journalwatch, 'XDG_CONFIG_HOME', str(tmpdir))
+    monkeypatch.setattr(journalwatch, 'CONFIG_DIR', str(tmpdir))
+    monkeypatch.setattr(journalwatch, 'CONFIG_FILE', str(tmpdir / 'config'))
+    monkeypatch.setattr(journalwatch, 'PATTERN_FILE', str(pattern_file))
+    monkeypatch.setattr(journalwatch, 'PATTERN_CACHE_FILE', str(cache_file))
+
+    pattern_file.write('_SYSTEMD_UNIT = foo\nbar\n')
+    _, patterns = journalwatch.parse_config_files()
+    assert cache_file.check()
+    _, cached = journalwatch.parse_config_files()
+    assert cached == patterns
+
+    # Different-length content, so the (mtime_ns, size) cache key changes
+    # even with coarse-grained inode timestamps.
+    pattern_file.write('_SYSTEMD_UNIT = foo\nbazquux\n')
+    _, updated = journalwatch.parse_config_files()
+    assert updated == {('_SYSTEMD_UNIT', 'foo'): [re.compile('(?:bazquux)')]}